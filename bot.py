@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 """
-Telegram expense bot (polling) + PostgreSQL storage + scheduled daily report.
+Telegram expense bot (long polling, or webhook when WEBHOOK_URL is set)
++ PostgreSQL storage + scheduled daily report.
 """
 
 import os
+import sys
+import re
+import json
+import random
+import calendar
+import functools
 import time
 import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
 import pytz
 from decimal import Decimal
 
@@ -25,19 +43,93 @@ if not TOKEN:
 
 URL = f"https://api.telegram.org/bot{TOKEN}"
 DATABASE_URL = os.getenv("DATABASE_URL")  # Railway sets this
-MONTHLY_BUDGET_ENV = float(os.getenv("MONTHLY_BUDGET", "300"))
+MONTHLY_BUDGET_ENV = Decimal(os.getenv("MONTHLY_BUDGET", "300"))
 REMINDER_CHAT_ID = os.getenv("REMINDER_CHAT_ID", "").strip() or None
 REMINDER_TIME = os.getenv("REMINDER_TIME", "").strip() or None
 TIMEZONE = os.getenv("TIMEZONE", "Asia/Dubai")
 ALLOWED_USER_IDS = [s.strip() for s in os.getenv("ALLOWED_USER_IDS", "").split(",") if s.strip()]
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/") or None  # public base URL
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or None
+PORT = int(os.getenv("PORT", "8080"))
+BUDGET_CACHE_TTL = 60  # seconds
+TOTALS_CACHE_TTL = 5  # seconds
+POLL_BACKOFF_MAX = 30  # seconds
+
+# Raise UPDATE_WORKERS to allow more concurrent in-flight updates; the DB
+# pool and HTTP pool are sized from it so workers never starve for either.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+DB_POOL_MIN = 1
+DB_POOL_MAX = UPDATE_WORKERS + 2  # workers + scheduler job + headroom
 
 tz = pytz.timezone(TIMEZONE)
 
 # ---------- Database helpers ----------
+# Server-side prepared statements for the hot paths. They live for the
+# lifetime of a session, so each pooled connection prepares them once.
+PREPARED_STATEMENTS = (
+    """
+    PREPARE ins_expense (bigint, text, numeric, text, text) AS
+    INSERT INTO expenses (user_id, username, amount, category, note) VALUES ($1, $2, $3, $4, $5)
+    """,
+    """
+    PREPARE sel_totals (bigint) AS
+    SELECT COALESCE(ROUND(SUM(amount) FILTER (WHERE created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + 1), 2), 0),
+           COALESCE(ROUND(SUM(amount), 2), 0),
+           COALESCE(ROUND(SUM(amount) FILTER (WHERE user_id = $1 AND created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + 1), 2), 0),
+           COALESCE(ROUND(SUM(amount) FILTER (WHERE user_id = $1), 2), 0)
+    FROM expenses
+    WHERE created_at >= date_trunc('month', now())
+      AND created_at < date_trunc('month', now()) + interval '1 month'
+    """,
+)
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers whether PREPARED_STATEMENTS ran on it."""
+    prepared = False
+
+# One pool per process: connections (and their TLS sessions) are reused
+# across handlers instead of being re-established for every query.
+POOL = (
+    psycopg2.pool.ThreadedConnectionPool(
+        DB_POOL_MIN, DB_POOL_MAX, dsn=DATABASE_URL, sslmode="require",
+        connection_factory=PooledConnection,
+    )
+    if DATABASE_URL else None
+)
+
+@contextmanager
 def db_conn():
-    if not DATABASE_URL:
+    if POOL is None:
         raise RuntimeError("DATABASE_URL not set")
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+    conn = POOL.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # Drop connections the server has closed so the pool opens a fresh one.
+        POOL.putconn(conn, close=bool(conn.closed))
+
+def ensure_prepared(conn):
+    # Called lazily from the helpers that EXECUTE, not from db_conn(), so
+    # init_db() can create the tables before anything is prepared.
+    if conn.prepared:
+        return
+    with conn.cursor() as cur:
+        # Clear leftovers from an earlier attempt that failed part-way.
+        cur.execute("DEALLOCATE ALL")
+        for sql in PREPARED_STATEMENTS:
+            cur.execute(sql)
+    conn.commit()
+    conn.prepared = True
+
+def close_db_pool():
+    if POOL is not None:
+        POOL.closeall()
+        logging.info("Database pool closed.")
 
 def init_db():
     sql_create_expenses = """
@@ -57,6 +149,10 @@ def init_db():
       value TEXT
     );
     """
+    sql_create_indexes = """
+    CREATE INDEX IF NOT EXISTS expenses_created_idx ON expenses (created_at DESC);
+    CREATE INDEX IF NOT EXISTS expenses_user_created_idx ON expenses (user_id, created_at DESC);
+    """
     sql_create_user_settings = """
     CREATE TABLE IF NOT EXISTS user_settings (
       user_id BIGINT PRIMARY KEY,
@@ -66,73 +162,71 @@ def init_db():
     with db_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(sql_create_expenses)
+            cur.execute(sql_create_indexes)
             cur.execute(sql_create_settings)
             cur.execute(sql_create_user_settings)
         conn.commit()
     logging.info("Database initialized.")
 
-def get_user_today_total(user_id):
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT SUM(amount) FROM expenses WHERE user_id=%s AND created_at::date = CURRENT_DATE",
-                (user_id,),
-            )
-            r = cur.fetchone()
-            return float(r[0]) if r and r[0] is not None else 0.0
-
 # ---------- DB operations ----------
 def add_expense_db(user_id, username, amount, category, note):
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO expenses (user_id, username, amount, category, note) VALUES (%s,%s,%s,%s,%s)",
-                (user_id, username, Decimal(amount), category, note),
-            )
-        conn.commit()
+    add_expenses_bulk([(user_id, username, Decimal(amount), category, note)])
 
-def get_all_expenses():
-    with db_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute("SELECT * FROM expenses ORDER BY created_at DESC")
-            return cur.fetchall()
-
-def get_month_totals():
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT SUM(amount)::numeric FROM expenses WHERE to_char(created_at, 'YYYY-MM') = to_char(now(), 'YYYY-MM')")
-            row = cur.fetchone()
-            return float(row[0]) if row and row[0] is not None else 0.0
-
-def get_today_total():
+def add_expenses_bulk(rows):
+    """Insert a list of (user_id, username, amount, category, note) tuples in one transaction."""
+    if not rows:
+        return
     with db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT SUM(amount) FROM expenses WHERE created_at::date = CURRENT_DATE")
-            row = cur.fetchone()
-            return float(row[0]) if row and row[0] is not None else 0.0
-
-def get_by_user_month():
-    with db_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute("""
-                SELECT COALESCE(username, user_id::text) AS user,
-                       SUM(amount) as total
-                FROM expenses
-                WHERE to_char(created_at, 'YYYY-MM') = to_char(now(), 'YYYY-MM')
-                GROUP BY COALESCE(username, user_id::text)
-                ORDER BY total DESC
-            """)
-            return cur.fetchall()
-
-def get_user_month_total(user_id):
+            if len(rows) == 1:
+                # Single messages are the common case; reuse the prepared insert.
+                ensure_prepared(conn)
+                cur.execute("EXECUTE ins_expense (%s,%s,%s,%s,%s)", rows[0])
+            else:
+                psycopg2.extras.execute_values(
+                    cur,
+                    "INSERT INTO expenses (user_id, username, amount, category, note) VALUES %s",
+                    rows,
+                    page_size=500,
+                )
+        conn.commit()
+    invalidate_totals()
+
+# Keyed by (user_id, time bucket); entries from older buckets are dropped
+# on the next miss, and any write clears the whole cache. The generation
+# counter stops a read that started before a write from re-caching its
+# pre-write result after the clear.
+_TOTALS_CACHE = {}
+_TOTALS_LOCK = threading.Lock()
+_TOTALS_GEN = 0
+
+def invalidate_totals():
+    global _TOTALS_GEN
+    with _TOTALS_LOCK:
+        _TOTALS_GEN += 1
+        _TOTALS_CACHE.clear()
+
+def get_user_and_global_totals(user_id):
+    """Today/month totals for everyone and for user_id from one index scan."""
+    bucket = int(time.time() // TOTALS_CACHE_TTL)
+    with _TOTALS_LOCK:
+        cached = _TOTALS_CACHE.get((user_id, bucket))
+        gen = _TOTALS_GEN
+    if cached is not None:
+        return cached
     with db_conn() as conn:
+        ensure_prepared(conn)
         with conn.cursor() as cur:
-            cur.execute(
-                "SELECT SUM(amount) FROM expenses WHERE user_id=%s AND to_char(created_at,'YYYY-MM') = to_char(now(),'YYYY-MM')",
-                (user_id,),
-            )
+            cur.execute("EXECUTE sel_totals (%s)", (user_id,))
             r = cur.fetchone()
-            return float(r[0]) if r and r[0] is not None else 0.0
+    keys = ("today_total", "month_total", "user_today_total", "user_month_total")
+    totals = dict(zip(keys, r))
+    with _TOTALS_LOCK:
+        if gen == _TOTALS_GEN:
+            for key in [k for k in _TOTALS_CACHE if k[1] != bucket]:
+                del _TOTALS_CACHE[key]
+            _TOTALS_CACHE[(user_id, bucket)] = totals
+    return totals
 
 def delete_last_user_expense(user_id):
     with db_conn() as conn:
@@ -142,7 +236,7 @@ def delete_last_user_expense(user_id):
                 DELETE FROM expenses
                 WHERE id = (
                   SELECT id FROM expenses
-                  WHERE user_id=%s AND to_char(created_at,'YYYY-MM') = to_char(now(),'YYYY-MM')
+                  WHERE user_id=%s AND created_at >= date_trunc('month', now()) AND created_at < date_trunc('month', now()) + interval '1 month'
                   ORDER BY created_at DESC
                   LIMIT 1
                 )
@@ -152,7 +246,8 @@ def delete_last_user_expense(user_id):
             )
             r = cur.fetchone()
         conn.commit()
-        return bool(r and r[0])
+    invalidate_totals()
+    return bool(r and r[0])
 
 def get_setting(key):
     with db_conn() as conn:
@@ -170,16 +265,92 @@ def set_setting(key, value):
                 (key, str(value)),
             )
         conn.commit()
+    if key == "budget":
+        _BUDGET_CACHE["ts"] = 0.0
 
-def get_budget():
-    val = get_setting("budget")
+# Arbitrary app-wide key for the daily report's advisory lock.
+DAILY_REPORT_LOCK_KEY = 7206101
+
+def claim_daily_report(day):
+    """Return True if this process should send the report for day.
+
+    During a redeploy two instances overlap and each runs its own scheduler
+    (APScheduler 3 can't share a job store between them). The advisory lock
+    lets one of them check and record the date at a time, so whichever comes
+    second, concurrently or minutes later, sees the report already sent.
+    """
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (DAILY_REPORT_LOCK_KEY,))
+            if not cur.fetchone()[0]:
+                return False
+            cur.execute("SELECT value FROM settings WHERE key='daily_report_sent'")
+            r = cur.fetchone()
+            if r and r[0] == day.isoformat():
+                return False
+            cur.execute(
+                "INSERT INTO settings (key,value) VALUES ('daily_report_sent',%s) "
+                "ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value",
+                (day.isoformat(),),
+            )
+        conn.commit()
+    return True
+
+def parse_budget(val):
     if val:
         try:
-            return float(val)
+            return Decimal(val)
         except:
             return MONTHLY_BUDGET_ENV
     return MONTHLY_BUDGET_ENV
 
+# The bot runs as a single process, so an in-memory copy stays coherent
+# as long as writes go through set_setting().
+_BUDGET_CACHE = {"value": None, "ts": 0.0}
+
+def get_budget():
+    if time.time() - _BUDGET_CACHE["ts"] < BUDGET_CACHE_TTL:
+        return _BUDGET_CACHE["value"]
+    value = parse_budget(get_setting("budget"))
+    _BUDGET_CACHE["value"] = value
+    _BUDGET_CACHE["ts"] = time.time()
+    return value
+
+def get_summary_bundle():
+    """Month/today totals, budget and per-user breakdown in one round-trip."""
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH m AS (
+                  SELECT COALESCE(ROUND(SUM(amount), 2), 0) AS month_total,
+                         COALESCE(ROUND(SUM(amount) FILTER (WHERE created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + 1), 2), 0) AS today_total
+                  FROM expenses
+                  WHERE created_at >= date_trunc('month', now())
+                    AND created_at < date_trunc('month', now()) + interval '1 month'
+                ),
+                b AS (SELECT value FROM settings WHERE key='budget'),
+                u AS (
+                  SELECT COALESCE(username, user_id::text) AS user,
+                         SUM(amount) AS total
+                  FROM expenses
+                  WHERE created_at >= date_trunc('month', now())
+                    AND created_at < date_trunc('month', now()) + interval '1 month'
+                  GROUP BY 1
+                )
+                SELECT (SELECT month_total FROM m),
+                       (SELECT today_total FROM m),
+                       (SELECT value FROM b),
+                       (SELECT json_agg(json_build_object('user', "user", 'total', ROUND(total, 2)::text)
+                                        ORDER BY total DESC) FROM u)
+            """)
+            month_total, today_total, budget, by_user = cur.fetchone()
+            return {
+                "month_total": month_total,
+                "today_total": today_total,
+                "budget": parse_budget(budget),
+                "by_user": [{"user": u["user"], "total": Decimal(u["total"])} for u in by_user or []],
+            }
+
 # ---------- Per-user budget helpers ----------
 def get_user_budget(user_id):
     with db_conn() as conn:
@@ -187,7 +358,7 @@ def get_user_budget(user_id):
             cur.execute("SELECT budget FROM user_settings WHERE user_id=%s", (user_id,))
             r = cur.fetchone()
             if r and r[0] is not None:
-                return float(r[0])
+                return r[0]
             return MONTHLY_BUDGET_ENV  # default 300
 
 def set_user_budget(user_id, amount):
@@ -201,12 +372,26 @@ def set_user_budget(user_id, amount):
         conn.commit()
 
 # ---------- Telegram helpers ----------
+# Shared keep-alive session so polls and sends reuse the same TLS connections.
+# Everything goes to api.telegram.org, so one small host pool is enough.
+# Only failures to connect are retried: the request never left, so even a
+# POST sendMessage is safe to resend. Read errors (a connection dropped
+# mid-request, a long-poll read timeout) are not, since the message may
+# already have gone out; those fail the call. A failed send is logged and
+# dropped, a failed poll is retried by the poll loop's backoff.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=UPDATE_WORKERS + 1,
+    max_retries=Retry(total=2, read=0, backoff_factor=0.3),
+))
+
 def send_message(chat_id, text, reply_markup=None):
     try:
         payload = {"chat_id": chat_id, "text": text}
         if reply_markup:
             payload["reply_markup"] = reply_markup
-        resp = requests.post(URL + "/sendMessage", json=payload)
+        resp = SESSION.post(URL + "/sendMessage", json=payload, timeout=10)
         resp.raise_for_status()
     except Exception as e:
         logging.exception("send_message failed: %s", e)
@@ -216,22 +401,40 @@ def send_markdown(chat_id, text, reply_markup=None):
         payload = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
         if reply_markup:
             payload["reply_markup"] = reply_markup
-        resp = requests.post(URL + "/sendMessage", json=payload)
+        resp = SESSION.post(URL + "/sendMessage", json=payload, timeout=10)
         resp.raise_for_status()
     except Exception as e:
         logging.exception("send_message failed: %s", e)
 
-def fetch_updates(offset=None, timeout=60):
+def fetch_updates(offset=None, timeout=50):
     try:
-        params = {"timeout": timeout}
+        params = {"timeout": timeout, "allowed_updates": '["message"]'}
         if offset:
             params["offset"] = offset
-        r = requests.get(URL + "/getUpdates", params=params, timeout=timeout + 10)
+        r = SESSION.get(URL + "/getUpdates", params=params, timeout=timeout + 5)
         return r.json()
     except Exception as e:
         logging.exception("fetch_updates failed: %s", e)
         return {}
 
+def set_webhook(url):
+    payload = {"url": url, "allowed_updates": ["message"], "max_connections": UPDATE_WORKERS}
+    if WEBHOOK_SECRET:
+        payload["secret_token"] = WEBHOOK_SECRET
+    resp = SESSION.post(URL + "/setWebhook", json=payload, timeout=10)
+    resp.raise_for_status()
+    if not resp.json().get("ok"):
+        raise RuntimeError(f"setWebhook failed: {resp.text}")
+
+def delete_webhook():
+    # Telegram rejects getUpdates while a webhook is registered, and a
+    # leftover webhook would route updates to another process.
+    try:
+        resp = SESSION.post(URL + "/deleteWebhook", json={"drop_pending_updates": False}, timeout=10)
+        resp.raise_for_status()
+    except Exception as e:
+        logging.exception("delete_webhook failed: %s", e)
+
 # ---------- Keyboards ----------
 def main_menu_keyboard():
     return {
@@ -250,31 +453,38 @@ def submenu_keyboard():
     }
 
 # ---------- Business logic ----------
+@functools.lru_cache(maxsize=32)
+def _month_length(year, month):
+    return calendar.monthrange(year, month)[1]
+
 def days_in_month(dt=None):
     if dt is None:
         dt = datetime.now(tz)
-    import calendar
-    return calendar.monthrange(dt.year, dt.month)[1]
-
-def compute_forecast_and_stats():
-    total_month = get_month_totals()
-    total_today = get_today_total()
+    return _month_length(dt.year, dt.month)
+
+def compute_forecast_and_stats(bundle):
+    """bundle: dict with month_total, today_total and budget, e.g. from
+    get_summary_bundle()."""
+    total_month = bundle["month_total"]
+    total_today = bundle["today_total"]
+    budget = bundle["budget"]
     now = datetime.now(tz)
     days_passed = now.day
     dim = days_in_month(now)
     avg_daily = total_month / max(days_passed, 1)
     predicted = avg_daily * dim
-    remaining = max(get_budget() - total_month, 0.0)
+    remaining = max(budget - total_month, Decimal(0))
     days_left = dim - now.day
     return {
-        "total_month": round(total_month, 2),
-        "total_today": round(total_today, 2),
-        "avg_daily": round(avg_daily, 2),
-        "predicted": round(predicted, 2),
-        "remaining": round(remaining, 2),
+        "total_month": total_month,
+        "total_today": total_today,
+        "avg_daily": avg_daily,
+        "predicted": predicted,
+        "remaining": remaining,
+        "budget": budget,
         "days_left": days_left,
         "days_in_month": dim,
-        "will_exceed": predicted > get_budget(),
+        "will_exceed": predicted > budget,
     }
 
 # ---------- Command parsing ----------
@@ -283,43 +493,63 @@ def is_allowed(user_id):
         return True
     return str(user_id) in ALLOWED_USER_IDS
 
+# "[/spent |add ]<amount> [category] [note...]"; "," or "." marks up to two decimals.
+EXPENSE_RE = re.compile(r'^(?:/spent\s+|add\s+)?([0-9]+(?:[.,][0-9]{1,2})?)(?:\s+(\S+))?(?:\s+(.+))?$', re.I | re.S)
+
 def parse_expense_text(text):
-    t = text.strip()
-    if t.startswith("/spent"):
-        t = t[len("/spent"):].strip()
-    if t.lower().startswith("add "):
-        t = t.split(" ", 1)[1].strip()
-    parts = t.split()
-    if not parts:
-        return None
-    try:
-        amt = parts[0].replace(",", "")
-        amt_val = float(amt)
-        category = parts[1] if len(parts) > 1 else ""
-        note = " ".join(parts[2:]) if len(parts) > 2 else ""
-        return (amt_val, category, note)
-    except (ValueError, IndexError):
+    m = EXPENSE_RE.match(text.strip())
+    if not m:
         return None
+    amt_val = Decimal(m.group(1).replace(",", "."))
+    # Notes may span lines; store them space-separated like before.
+    note = " ".join((m.group(3) or "").split())
+    return (amt_val, m.group(2) or "", note)
 
 # ---------- Scheduled daily report ----------
 def send_daily_report_job():
     if not REMINDER_CHAT_ID or not REMINDER_TIME:
         logging.info("Daily reminder not configured; skipping daily report.")
         return
-    stats = compute_forecast_and_stats()
+    if not claim_daily_report(datetime.now(tz).date()):
+        logging.info("Daily report already sent by another instance; skipping.")
+        return
+    stats = compute_forecast_and_stats(bundle=get_summary_bundle())
     lines = [
         "⏰ Daily Budget Summary",
-        f"Today: {stats['total_today']} AED",
-        f"This month: {stats['total_month']} AED",
+        f"Today: {stats['total_today']:.2f} AED",
+        f"This month: {stats['total_month']:.2f} AED",
         f"Days left: {stats['days_left']} / {stats['days_in_month']}",
-        f"Budget: {get_budget()} AED, Remaining: {stats['remaining']} AED",
-        f"Predicted end: {stats['predicted']} AED {'⚠️ Over budget' if stats['will_exceed'] else '✅ On track'}",
+        f"Budget: {stats['budget']:.2f} AED, Remaining: {stats['remaining']:.2f} AED",
+        f"Predicted end: {stats['predicted']:.2f} AED {'⚠️ Over budget' if stats['will_exceed'] else '✅ On track'}",
     ]
     send_markdown(REMINDER_CHAT_ID, "\n".join(lines))
     logging.info("Daily reminder sent to %s", REMINDER_CHAT_ID)
 
-def schedule_daily_job():
+def start_scheduler():
+    # SQLAlchemy only accepts the postgresql:// scheme.
+    jobstore_url = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+    # Jobs persist in Postgres with their next_run_time, so a reminder that
+    # came due while the bot was down is fired once on the next start
+    # (within misfire_grace_time) instead of skipped.
+    sched = BackgroundScheduler(
+        timezone=tz,
+        jobstores={"default": SQLAlchemyJobStore(
+            url=jobstore_url, engine_options={"connect_args": {"sslmode": "require"}}
+        )},
+        job_defaults={"coalesce": True, "misfire_grace_time": 3600, "max_instances": 1},
+    )
+    sched.start()
+    schedule_daily_job(sched)
+    return sched
+
+def schedule_daily_job(sched):
+    # Must run after sched.start(): get_job() only sees the persistent store
+    # once the scheduler is running. Re-adding with replace_existing would
+    # overwrite the stored next_run_time and silently drop a missed run.
+    job = sched.get_job("daily_report")
     if not REMINDER_TIME or not REMINDER_CHAT_ID:
+        if job is not None:
+            sched.remove_job("daily_report")
         logging.info("No REMINDER_TIME or REMINDER_CHAT_ID set; skipping scheduling.")
         return
     try:
@@ -327,133 +557,305 @@ def schedule_daily_job():
     except:
         logging.error("Invalid REMINDER_TIME format. Use HH:MM (24h).")
         return
-    sched = BackgroundScheduler(timezone=tz)
-    sched.start()
-    sched.add_job(send_daily_report_job, "cron", hour=hh, minute=mm)
+    trigger = CronTrigger(hour=hh, minute=mm, timezone=tz)
+    if job is None:
+        sched.add_job(send_daily_report_job, trigger, id="daily_report")
+    elif str(job.trigger) != str(trigger) or str(job.trigger.timezone) != str(tz):
+        sched.reschedule_job("daily_report", trigger=trigger)
     logging.info("Scheduled daily job at %02d:%02d %s", hh, mm, TIMEZONE)
 
-# ---------- Main polling loop ----------
+# ---------- Command handlers ----------
+# Every handler takes (chat_id, user_id, username, args, text).
+def handle_start(chat_id, user_id, username, args, text):
+    send_message(chat_id,
+        "👋 Hi! Send expenses like: `50 food lunch` or `/spent 50 food lunch`. "
+        "Use /summary for stats.",
+        reply_markup=main_menu_keyboard()
+    )
+
+def handle_spent(chat_id, user_id, username, args, text):
+    parsed = parse_expense_text(text)
+    if not parsed:
+        send_message(chat_id, "Usage: /spent <amount> [category] [note]")
+    else:
+        amt, cat, note = parsed
+        add_expense_db(user_id, username, amt, cat, note)
+        send_message(chat_id, f"✅ Logged {amt:.2f} AED ({cat})")
+
+def handle_daily(chat_id, user_id, username, args, text):
+    totals = get_user_and_global_totals(user_id)
+    send_message(chat_id, f"Your spending today: {totals['user_today_total']:.2f} AED")
+
+def handle_monthly(chat_id, user_id, username, args, text):
+    totals = get_user_and_global_totals(user_id)
+    send_message(chat_id, f"This month's total: {totals['month_total']:.2f} AED")
+
+def handle_predict(chat_id, user_id, username, args, text):
+    totals = get_user_and_global_totals(user_id)
+    stats = compute_forecast_and_stats(bundle=dict(totals, budget=get_budget()))
+    send_message(chat_id, f"Forecast: {stats['predicted']:.2f} AED. {'⚠️ You will exceed budget!' if stats['will_exceed'] else '✅ On track'}")
+
+def handle_summary(chat_id, user_id, username, args, text):
+    bundle = get_summary_bundle()
+    s = compute_forecast_and_stats(bundle=bundle)
+    lines = [
+        f"📊 Summary - {datetime.now(tz).strftime('%Y-%m')}",
+        f"Today: {s['total_today']:.2f} AED",
+        f"Month: {s['total_month']:.2f} AED",
+        f"Remaining: {s['remaining']:.2f} AED (Budget {s['budget']:.2f} AED)",
+        f"Days left: {s['days_left']}",
+        f"Forecast: {s['predicted']:.2f} AED {'⚠️' if s['will_exceed'] else ''}",
+        "",
+        "🔎 By user:",
+    ]
+    for u in bundle["by_user"]:
+        lines.append(f"- {u['user']}: {u['total']:.2f} AED")
+    send_markdown(chat_id, "\n".join(lines))
+
+def handle_me(chat_id, user_id, username, args, text):
+    total = get_user_and_global_totals(user_id)["user_month_total"]
+    send_message(chat_id, f"You spent {total:.2f} AED this month.")
+
+def handle_undo(chat_id, user_id, username, args, text):
+    ok = delete_last_user_expense(user_id)
+    send_message(chat_id, "✅ Last expense removed." if ok else "Nothing to undo.")
+
+def handle_setbudget(chat_id, user_id, username, args, text):
+    if not args:
+        send_message(chat_id, "Usage: /setbudget <amount>")
+        return
+    try:
+        new_b = Decimal(args[0])
+        set_user_budget(user_id, new_b)
+        send_message(chat_id, f"✅ Your budget updated to {new_b:.2f} AED")
+    except Exception:
+        send_message(chat_id, "Invalid amount.")
+
+def handle_budget(chat_id, user_id, username, args, text):
+    send_message(chat_id, f"Your budget: {get_user_budget(user_id):.2f} AED")
+
+def handle_balance(chat_id, user_id, username, args, text):
+    total_spent = get_user_and_global_totals(user_id)["user_month_total"]
+    budget = get_user_budget(user_id)
+    remaining = budget - total_spent
+    send_message(chat_id, f"Your balance: {remaining:.2f} AED (Spent {total_spent:.2f} / Budget {budget:.2f})")
+
+def handle_daysleft(chat_id, user_id, username, args, text):
+    # Calendar only; no need to query totals.
+    now = datetime.now(tz)
+    dim = days_in_month(now)
+    send_message(chat_id, f"Days left: {dim - now.day} of {dim}")
+
+def handle_whoami(chat_id, user_id, username, args, text):
+    send_message(chat_id, f"Your ID: {user_id}\nChat ID: {chat_id}")
+
+HANDLERS = {
+    "/start": handle_start,
+    "/spent": handle_spent,
+    "/daily": handle_daily,
+    "/today": handle_daily,
+    "/monthly": handle_monthly,
+    "/total": handle_monthly,
+    "/predict": handle_predict,
+    "/summary": handle_summary,
+    "/me": handle_me,
+    "/undo": handle_undo,
+    "/setbudget": handle_setbudget,
+    "/budget": handle_budget,
+    "/balance": handle_balance,
+    "/daysleft": handle_daysleft,
+    "/whoami": handle_whoami,
+}
+
+# ---------- Main loop ----------
+# Updates from different users are handled in parallel on the executor;
+# updates from the same user run one at a time and in arrival order, so
+# e.g. "50 food" followed by "/undo" never races.
+EXECUTOR = ThreadPoolExecutor(max_workers=UPDATE_WORKERS)
+
+def update_user_key(up):
+    return up.get("message", {}).get("from", {}).get("id")
+
+def process_in_order(updates):
+    for up in updates:
+        process_update(up)
+
+def process_batch(updates):
+    """Handle one getUpdates batch and return once every update is done."""
+    by_user = {}
+    for up in updates:
+        by_user.setdefault(update_user_key(up), []).append(up)
+    futures = [EXECUTOR.submit(process_in_order, ups) for ups in by_user.values()]
+    for future in futures:
+        future.result()
+
+# A fixed set of lock stripes rather than one lock per sender, so the table
+# doesn't grow with every user (allowed or not) who ever messages the bot.
+# Two users sharing a stripe are merely serialized.
+USER_LOCK_STRIPES = 64
+_USER_LOCKS = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+def user_lock(key):
+    return _USER_LOCKS[hash(key) % USER_LOCK_STRIPES]
+
+# Railway stops the process with SIGTERM. Outside a polling batch it becomes
+# SystemExit right away, so the long poll / webhook server unwind through
+# main()'s cleanup. During a batch it only sets _STOP: run_polling() lets
+# the batch finish and advances the offset first, so handled updates are
+# confirmed instead of redelivered (and inserted or undone twice).
+_STOP = threading.Event()
+_IN_BATCH = threading.Event()
+
+def handle_sigterm(signum, frame):
+    if _STOP.is_set():
+        return  # already shutting down; don't interrupt the cleanup
+    _STOP.set()
+    if not _IN_BATCH.is_set():
+        sys.exit(0)
+
 def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
     init_db()
-    schedule_daily_job()
+    sched = start_scheduler()
+    try:
+        if WEBHOOK_URL:
+            run_webhook()
+        else:
+            run_polling()
+    finally:
+        # Scheduler first: a reminder that is mid-send still needs the pool.
+        sched.shutdown(wait=True)
+        EXECUTOR.shutdown(wait=True)
+        close_db_pool()
+
+def run_polling():
+    delete_webhook()
     logging.info("Bot started (polling).")
     offset = None
-    while True:
-        updates = fetch_updates(offset=offset, timeout=60)
-        if not updates or "result" not in updates:
-            time.sleep(1)
-            continue
-        for up in updates["result"]:
-            offset = up["update_id"] + 1
+    backoff = 1.0
+    try:
+        while not _STOP.is_set():
+            # getUpdates blocks server-side until an update arrives or the
+            # timeout expires, so the loop only sleeps after a failed poll.
+            # An empty result list is a normal long-poll timeout, not an error.
+            updates = fetch_updates(offset=offset)
+            if not updates or "result" not in updates:
+                time.sleep(min(backoff + random.random() * 0.25, POLL_BACKOFF_MAX))
+                backoff = min(backoff * 2, POLL_BACKOFF_MAX)
+                continue
+            backoff = 1.0
+            if updates["result"]:
+                # The next poll confirms everything below offset to Telegram, so
+                # only advance it once the batch is handled; a crash mid-batch
+                # gets the same updates again instead of losing them.
+                _IN_BATCH.set()
+                try:
+                    process_batch(updates["result"])
+                    offset = updates["result"][-1]["update_id"] + 1
+                finally:
+                    _IN_BATCH.clear()
+    finally:
+        if offset is not None:
+            # Confirm the last handled batch without waiting for new updates,
+            # so the next instance doesn't get it again.
+            fetch_updates(offset=offset, timeout=0)
+
+# The token in the path keeps the endpoint unguessable.
+WEBHOOK_PATH = f"/{TOKEN}"
+
+class WebhookServer(ThreadingHTTPServer):
+    # Non-daemon handler threads are joined by server_close(), so updates in
+    # flight at shutdown are handled and answered before the executor stops.
+    daemon_threads = False
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            up = json.loads(self.rfile.read(length))
+        except ValueError:
+            up = None
+        # Valid JSON that isn't an object ([], 1, "x") is no update either.
+        if not isinstance(up, dict):
+            self.send_error(400)
+            return
+        # Reply only after the update is handled, so Telegram redelivers it
+        # if the process dies first. max_connections=UPDATE_WORKERS keeps
+        # concurrent deliveries within the executor's capacity.
+        with user_lock(update_user_key(up)):
+            EXECUTOR.submit(process_update, up).result()
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, fmt, *args):
+        # Request lines include the token; keep them out of the logs.
+        pass
+
+def run_webhook():
+    server = WebhookServer(("", PORT), WebhookHandler)
+    set_webhook(WEBHOOK_URL + WEBHOOK_PATH)
+    logging.info("Bot started (webhook on port %d).", PORT)
+    try:
+        server.serve_forever()
+    finally:
+        # Stops accepting and waits for in-flight handlers to reply.
+        # The webhook is deliberately left registered: during a rolling
+        # redeploy the replacement instance has already set the same URL,
+        # and Telegram retries deliveries until it answers.
+        server.server_close()
+
+def process_update(up):
+    try:
+        if "message" not in up:
+            return
+        msg = up["message"]
+        chat_id = msg["chat"]["id"]
+        user_id = msg["from"]["id"]
+        username = msg["from"].get("first_name") or msg["from"].get("username") or str(user_id)
+        text = msg.get("text", "").strip()
+        logging.info("Received from %s (%s): %s", username, user_id, text)
+
+        if not is_allowed(user_id):
+            send_message(chat_id, "🚫 You are not allowed to use this bot.")
+            return
+
+        # ---------- Menu Handling ----------
+        if text == "📋 All Menu":
+            send_message(chat_id, "Choose an option:", reply_markup=submenu_keyboard())
+            return
+        elif text == "⬅️ Back":
+            send_message(chat_id, "Back to main menu.", reply_markup=main_menu_keyboard())
+            return
+
+        if text.startswith("/"):
+            parts = text.split()
+            cmd = parts[0].lower()
+            handler = HANDLERS.get(cmd)
+            if handler:
+                handler(chat_id, user_id, username, parts[1:], text)
+            else:
+                send_message(chat_id, "Unknown command. Use /summary, /spent, /daily, /predict.")
+            return
+
+        parsed = parse_expense_text(text)
+        if parsed:
+            amt, cat, note = parsed
             try:
-                if "message" not in up:
-                    continue
-                msg = up["message"]
-                chat_id = msg["chat"]["id"]
-                user_id = msg["from"]["id"]
-                username = msg["from"].get("first_name") or msg["from"].get("username") or str(user_id)
-                text = msg.get("text", "").strip()
-                logging.info("Received from %s (%s): %s", username, user_id, text)
-
-                if not is_allowed(user_id):
-                    send_message(chat_id, "🚫 You are not allowed to use this bot.")
-                    continue
-
-                # ---------- Menu Handling ----------
-                if text == "📋 All Menu":
-                    send_message(chat_id, "Choose an option:", reply_markup=submenu_keyboard())
-                    continue
-                elif text == "⬅️ Back":
-                    send_message(chat_id, "Back to main menu.", reply_markup=main_menu_keyboard())
-                    continue
-
-                if text.startswith("/"):
-                    parts = text.split()
-                    cmd = parts[0].lower()
-                    args = parts[1:]
-                    if cmd == "/start":
-                        send_message(chat_id,
-                            "👋 Hi! Send expenses like: `50 food lunch` or `/spent 50 food lunch`. "
-                            "Use /summary for stats.",
-                            reply_markup=main_menu_keyboard()
-                        )
-                    elif cmd == "/spent":
-                        parsed = parse_expense_text(text)
-                        if not parsed:
-                            send_message(chat_id, "Usage: /spent <amount> [category] [note]")
-                        else:
-                            amt, cat, note = parsed
-                            add_expense_db(user_id, username, amt, cat, note)
-                            send_message(chat_id, f"✅ Logged {amt} AED ({cat})")
-                    elif cmd in ["/daily", "/today"]:
-                        send_message(chat_id, f"Your spending today: {get_user_today_total(user_id)} AED")
-                    elif cmd in ["/monthly", "/total"]:
-                        send_message(chat_id, f"This month's total: {get_month_totals()} AED")
-                    elif cmd == "/predict":
-                        stats = compute_forecast_and_stats()
-                        send_message(chat_id, f"Forecast: {stats['predicted']} AED. {'⚠️ You will exceed budget!' if stats['will_exceed'] else '✅ On track'}")
-                    elif cmd == "/summary":
-                        s = compute_forecast_and_stats()
-                        by_user = get_by_user_month()
-                        lines = [
-                            f"📊 Summary - {datetime.now(tz).strftime('%Y-%m')}",
-                            f"Today: {s['total_today']} AED",
-                            f"Month: {s['total_month']} AED",
-                            f"Remaining: {s['remaining']} AED (Budget {get_budget()} AED)",
-                            f"Days left: {s['days_left']}",
-                            f"Forecast: {s['predicted']} AED {'⚠️' if s['will_exceed'] else ''}",
-                            "",
-                            "🔎 By user:",
-                        ]
-                        for u in by_user:
-                            lines.append(f"- {u['user']}: {u['total']} AED")
-                        send_markdown(chat_id, "\n".join(lines))
-                    elif cmd == "/me":
-                        total = get_user_month_total(user_id)
-                        send_message(chat_id, f"You spent {total} AED this month.")
-                    elif cmd == "/undo":
-                        ok = delete_last_user_expense(user_id)
-                        send_message(chat_id, "✅ Last expense removed." if ok else "Nothing to undo.")
-                    elif cmd == "/setbudget":
-                        if not args:
-                            send_message(chat_id, "Usage: /setbudget <amount>")
-                        else:
-                            try:
-                                new_b = float(args[0])
-                                set_user_budget(user_id, new_b)
-                                send_message(chat_id, f"✅ Your budget updated to {new_b} AED")
-                            except Exception:
-                                send_message(chat_id, "Invalid amount.")
-                    elif cmd == "/budget":
-                        send_message(chat_id, f"Your budget: {get_user_budget(user_id)} AED")
-                    elif cmd == "/balance":
-                        total_spent = get_user_month_total(user_id)
-                        budget = get_user_budget(user_id)
-                        remaining = budget - total_spent
-                        send_message(chat_id, f"Your balance: {remaining} AED (Spent {total_spent} / Budget {budget})")
-                    elif cmd == "/daysleft":
-                        s = compute_forecast_and_stats()
-                        send_message(chat_id, f"Days left: {s['days_left']} of {s['days_in_month']}")
-                    elif cmd == "/whoami":
-                        send_message(chat_id, f"Your ID: {user_id}\nChat ID: {chat_id}")
-                    else:
-                        send_message(chat_id, "Unknown command. Use /summary, /spent, /daily, /predict.")
-                    continue
-
-                parsed = parse_expense_text(text)
-                if parsed:
-                    amt, cat, note = parsed
-                    try:
-                        add_expense_db(user_id, username, amt, cat, note)
-                        send_message(chat_id, f"✅ Logged {amt} AED ({cat})")
-                    except Exception:
-                        logging.exception("DB insert failed")
-                        send_message(chat_id, "❌ Failed to save expense.")
-                else:
-                    send_message(chat_id, "I didn't understand. Send `/spent 50 food note` or just `50 food note`.")
+                add_expense_db(user_id, username, amt, cat, note)
+                send_message(chat_id, f"✅ Logged {amt:.2f} AED ({cat})")
             except Exception:
-                logging.exception("Error processing update")
-        time.sleep(0.5)
+                logging.exception("DB insert failed")
+                send_message(chat_id, "❌ Failed to save expense.")
+        else:
+            send_message(chat_id, "I didn't understand. Send `/spent 50 food note` or just `50 food note`.")
+    except Exception:
+        logging.exception("Error processing update")
 
 if __name__ == "__main__":
     main()